@@ -3,25 +3,89 @@ import pandas as pd # IMPORTANTE: Para la tabla de ranking
 from src.retrieval import Retriever
 from src.reranker import Reranker
 from src.rag_engine import RagEngine
-import os
+from src.session import ConversationMemory, MAX_SESSION_BYTES
+from src.snapshots import THUMB_SIZE
+from PIL import Image
+import io
 
 # --- CONFIGURACIÓN ---
+THUMB_CACHE_SIZE = 512      # Miniaturas en memoria (LRU compartido entre sesiones)
+METADATA_CACHE_SIZE = 256   # Resultados (tuplas de ids) cuya metadata queda en memoria
+PREVIEW_SIZE = (200, 200)   # Vista previa de la imagen subida que se guarda en la sesión
+
 st.set_page_config(page_title="Amazon AI Shopper", layout="centered")
 st.markdown("""<style>.stDeployButton {display:none;} .block-container {padding-top: 2rem;}</style>""", unsafe_allow_html=True)
 
 # --- ESTADO ---
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-if "last_products" not in st.session_state:
-    st.session_state.last_products = []
-if "debug_ranking" not in st.session_state: # Nuevo estado para guardar la tabla
-    st.session_state.debug_ranking = None
+# Solo ids + scores por producto; la metadata se pide al Retriever al mostrar
+if "memory" not in st.session_state:
+    st.session_state.memory = ConversationMemory()
+memory = st.session_state.memory
 
 # --- CARGA ---
 @st.cache_resource
 def load_models():
     return Retriever(), Reranker()
 
+@st.cache_resource(max_entries=THUMB_CACHE_SIZE, show_spinner=False)
+def load_thumbnail(path, resize=False):
+    """
+    Bytes de la miniatura (None si no existe). Queda en memoria, así que los
+    reruns no vuelven a tocar el disco. resize=True genera la miniatura al vuelo
+    para índices antiguos que solo tienen image_path.
+    """
+    try:
+        if not resize:
+            with open(path, "rb") as f:
+                return f.read()
+        with Image.open(path) as img:
+            return to_jpeg(img, THUMB_SIZE)
+    except OSError:
+        return None
+
+def to_jpeg(img, size):
+    img = img.convert("RGB")
+    img.thumbnail(size)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
+
+@st.cache_resource(max_entries=METADATA_CACHE_SIZE, show_spinner=False)
+def fetch_metadatas(ids, index_path):
+    # index_path forma parte de la clave: tras un swap de snapshot se vuelve a pedir la metadata
+    return retriever.get_metadatas(ids)
+
+def hydrate(records):
+    """Registros compactos (id + scores) -> productos con metadata"""
+    if not records:
+        return []
+    metas = fetch_metadatas(tuple(r['id'] for r in records), retriever.index_path())
+    return [{**r, "metadata": metas[r['id']]} for r in records if r['id'] in metas]
+
+def ranking_table(products):
+    """Tabla de ranking, se arma solo al mostrarla (None si no hubo re-ranking)"""
+    if not products or products[0].get('rerank_score') is None:
+        return None
+    return pd.DataFrame([{
+        "Producto": p['metadata']['title'][:30],
+        "Score CLIP (Original)": f"{p['score']:.4f}",
+        "Score Re-Ranker": f"{p['rerank_score']:.4f}"
+    } for p in products])
+
+def render_products(products):
+    st.write("---")
+    cols = st.columns(3)
+    for i, prod in enumerate(products):
+        meta = prod['metadata']
+        with cols[i % 3]:
+            if meta.get('thumb_path'):
+                thumb = load_thumbnail(meta['thumb_path'])
+            else:
+                thumb = load_thumbnail(meta['image_path'], resize=True)
+            if thumb:
+                st.image(thumb, use_container_width=True)
+            st.caption(f"**{meta['title'][:40]}...**\n💲{meta['price']}")
+
 try:
     retriever, reranker = load_models()
 except Exception as e:
@@ -34,12 +98,16 @@ with st.sidebar:
     api_key = st.text_input("Gemini API Key", type="password")
     st.divider()
     top_k = st.slider("Productos a mostrar", 1, 10, 3)
+    memory.max_bytes = st.slider(
+        "Memoria máx. de la conversación (KB)", 64, 4096, MAX_SESSION_BYTES // 1024, step=64
+    ) * 1024
     st.divider()
     
     # MOSTRAR TABLA DE RANKING EN SIDEBAR (Opcional, también saldrá en el chat)
-    if st.session_state.debug_ranking is not None:
+    debug_ranking = ranking_table(hydrate(memory.last_results))
+    if debug_ranking is not None:
         st.subheader("📊 Análisis de Re-ranking (Último)")
-        st.dataframe(st.session_state.debug_ranking, hide_index=True)
+        st.dataframe(debug_ranking, hide_index=True)
 
 rag = RagEngine(api_key=api_key if api_key else None)
 
@@ -47,27 +115,27 @@ st.title("🛍️ Amazon AI Shopper")
 st.caption("Búsqueda con Contexto y Re-ranking")
 
 # --- HISTORIAL ---
-for msg in st.session_state.messages:
+# Los turnos antiguos ya no se redibujan: quedan plegados en el resumen
+if memory.summary:
+    with st.expander(f"🗂️ {memory.summarized_messages} mensajes anteriores resumidos"):
+        st.markdown(memory.summary)
+
+for msg in memory.messages:
     with st.chat_message(msg["role"]):
-        if msg.get("image_path"): st.image(msg["image_path"], width=200)
+        if msg.get("image"): st.image(msg["image"], width=200)
         if msg["content"]: st.markdown(msg["content"])
         
         # Mostrar productos si existen en este mensaje
-        if msg.get("products"):
+        products = hydrate(msg.get("products"))
+        if products:
             with st.container():
-                st.write("---")
-                cols = st.columns(3)
-                for i, prod in enumerate(msg["products"]):
-                    meta = prod['metadata']
-                    with cols[i % 3]:
-                        if os.path.exists(meta['image_path']):
-                            st.image(meta['image_path'], use_container_width=True)
-                        st.caption(f"**{meta['title'][:40]}...**\n💲{meta['price']}")
+                render_products(products)
             
             # Mostrar botón expandible con los datos del Ranking de ESA búsqueda
-            if msg.get("ranking_data") is not None:
+            ranking_df = ranking_table(products)
+            if ranking_df is not None:
                 with st.expander("📊 Ver Análisis de Ranking (Técnico)"):
-                    st.dataframe(msg["ranking_data"], hide_index=True)
+                    st.dataframe(ranking_df, hide_index=True)
 
 # --- INPUT ---
 with st.expander("📷 Buscar por imagen", expanded=False):
@@ -76,30 +144,30 @@ with st.expander("📷 Buscar por imagen", expanded=False):
 if prompt := st.chat_input("Escribe tu búsqueda..."):
     
     # 1. Manejo Input Usuario
-    image_search_path = None
+    # La imagen se queda en memoria: el Retriever la recibe como bytes (sin archivos temporales)
+    query_image = None
     if uploaded_file:
-        image_search_path = f"temp_{uploaded_file.name}"
-        with open(image_search_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+        query_image = uploaded_file.getvalue()
         with st.chat_message("user"):
-            st.image(image_search_path, width=200)
+            st.image(query_image, width=200)
             st.write(prompt)
-        st.session_state.messages.append({"role": "user", "content": f"[Imagen] {prompt}", "image_path": image_search_path})
+        # En la sesión solo queda una vista previa pequeña, no la foto original
+        memory.add_user(f"[Imagen] {prompt}", image=to_jpeg(Image.open(io.BytesIO(query_image)), PREVIEW_SIZE))
     else:
         with st.chat_message("user"):
             st.markdown(prompt)
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        memory.add_user(prompt)
 
     # 2. Procesamiento IA
     with st.chat_message("assistant"):
         with st.spinner("Procesando contexto y ranking..."):
             
-            chat_history_text = [m["content"] for m in st.session_state.messages]
+            chat_history_text = memory.history_text()
             
             # A. REESCRITURA DE QUERY (Contexto)
             effective_query = prompt
-            if not image_search_path:
-                effective_query = rag.rewrite_query(prompt, chat_history_text[:-1]) # No incluimos el actual para no confundir
+            if not query_image:
+                effective_query = rag.rewrite_query(prompt, chat_history_text[:-1], summary=memory.summary) # No incluimos el actual para no confundir
                 if effective_query != prompt:
                     st.caption(f" *Búsqueda contextual interpretada: '{effective_query}'*")
             
@@ -109,63 +177,46 @@ if prompt := st.chat_input("Escribe tu búsqueda..."):
             final_products = []
             ranking_df = None
             
-            if intent == "SEARCH" or image_search_path:
+            if intent == "SEARCH" or query_image:
                 # 1. Retrieval
-                fetch_k = top_k * 4 # Traemos más para ver el efecto del re-ranking
+                fetch_k = top_k * 2 # La fusión imagen+texto ya filtra mejor, basta con menos candidatos para el re-ranking
                 candidates = []
-                if image_search_path:
-                    candidates = retriever.search_by_image(image_search_path, k=fetch_k)
+                if query_image:
+                    candidates = retriever.search_by_image(query_image, k=fetch_k)
                 else:
-                    candidates = retriever.search_by_text(effective_query, k=fetch_k)
+                    candidates = retriever.search_hybrid(effective_query, k=fetch_k)
                 
                 # 2. Re-ranking
-                if candidates and (effective_query or image_search_path):
+                if candidates and (effective_query or query_image):
                     # Texto para rerank: si es imagen, usamos el prompt o "producto similar"
                     text_for_rerank = effective_query if effective_query else "producto similar visualmente"
                     final_products = reranker.rerank(text_for_rerank, candidates, top_k=top_k)
                     
                     # --- CREAR TABLA DE DATOS PARA INFORME ---
-                    # Combinamos los datos antes del corte top_k para ver el efecto
-                    # Pero para mostrar en pantalla, mostramos los finales vs sus scores originales
-                    ranking_data = []
-                    for p in final_products:
-                        ranking_data.append({
-                            "Producto": p['metadata']['title'][:30],
-                            "Score CLIP (Original)": f"{p['score']:.4f}",
-                            "Score Re-Ranker": f"{p['rerank_score']:.4f}"
-                        })
-                    ranking_df = pd.DataFrame(ranking_data)
-                    st.session_state.debug_ranking = ranking_df # Guardar en sidebar
+                    # Mostramos los finales vs sus scores originales
+                    ranking_df = ranking_table(final_products)
                 else:
                     final_products = candidates[:top_k]
-                
-                st.session_state.last_products = final_products
             
             else:
                 # Intención DETAILS
-                final_products = st.session_state.last_products
+                final_products = hydrate(memory.last_results)
             
             # C. Respuesta Generada
             response_text = rag.generate_response(
                 query=effective_query,
                 top_products=final_products,
                 history=chat_history_text,
-                intent=intent
+                intent=intent,
+                summary=memory.summary
             )
             
             st.markdown(response_text)
             
             # D. Mostrar Resultados y Tabla
             products_to_save = []
-            if (intent == "SEARCH" or image_search_path) and final_products:
-                st.write("---")
-                cols = st.columns(3)
-                for i, prod in enumerate(final_products):
-                    meta = prod['metadata']
-                    with cols[i % 3]:
-                        if os.path.exists(meta['image_path']):
-                            st.image(meta['image_path'], use_container_width=True)
-                        st.caption(f"**{meta['title'][:40]}...**\n💲{meta['price']}")
+            if (intent == "SEARCH" or query_image) and final_products:
+                render_products(final_products)
                 products_to_save = final_products
                 
                 # Mostrar Tabla de Ranking AQUÍ MISMO
@@ -174,10 +225,6 @@ if prompt := st.chat_input("Escribe tu búsqueda..."):
                         st.write("Comparativa de puntajes. El 'Score Re-Ranker' es el definitivo.")
                         st.dataframe(ranking_df, use_container_width=True)
 
-            # Guardar en historial
-            st.session_state.messages.append({
-                "role": "assistant", 
-                "content": response_text,
-                "products": products_to_save,
-                "ranking_data": ranking_df
-            })
\ No newline at end of file
+            # Guardar en historial (compacto) y plegar turnos viejos en el resumen
+            memory.add_assistant(response_text, products_to_save)
+            memory.compact(rag.summarize_history)
\ No newline at end of file
@@ -3,78 +3,147 @@ import chromadb
 from PIL import Image
 from transformers import CLIPProcessor, CLIPModel
 import torch
+import hashlib
 import os
+import shutil
 import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+try:
+    from src.snapshots import (new_snapshot_dir, write_manifest, publish, gc_snapshots, gc_thumbnails,
+                               THUMB_DIR, THUMB_SIZE, THUMB_QUALITY)
+except ImportError:  # Ejecutado como script: python src/indexer.py
+    from snapshots import (new_snapshot_dir, write_manifest, publish, gc_snapshots, gc_thumbnails,
+                           THUMB_DIR, THUMB_SIZE, THUMB_QUALITY)
 
 # --- CONFIGURACION ---
 CSV_PATH = 'data/final_corpus.csv'
-DB_PATH = 'db/chroma_db'            
 COLLECTION_NAME = 'amazon_products'
+TEXT_COLLECTION_NAME = 'amazon_products_text'  # Embeddings CLIP de titulo + descripcion
 BATCH_SIZE = 32                     
+MAX_TEXT_TOKENS = 77                # Limite de contexto del text encoder de CLIP
+VALIDATION_SAMPLES = 5              # Consultas de prueba antes de publicar el snapshot
+NUM_SHARDS = 1                      # >1 activa el modo particionado (un proceso por shard)
+SHARD_BY = 'hash'                   # 'hash' (parent_asin) o 'category' (columna 'category')
 
-def main():
-    print("INICIANDO INDEXADOR V5")
-    
-    # 1. Cargar CSV
-    if not os.path.exists(CSV_PATH):
-        print(f"Error: No existe {CSV_PATH}")
-        return
-    
-    df = pd.read_csv(CSV_PATH)
-    print(f" Total ítems en CSV: {len(df)}")
-    
-    # --- DIAGNÓSTICO DE COLUMNAS ---
-    # Vamos a asegurarnos de que el precio y descripción existan
-    print(f"   Columnas detectadas: {list(df.columns)}")
-    
-    # Rellenar vacíos para que no rompa el código
-    if 'price' not in df.columns:
-        df['price'] = "N/A"
-    if 'text_content' not in df.columns:
-        # Si no hay text_content, intentamos crear uno con title + description si existen
-        print("'text_content' no detectado. Intentando construirlo...")
-        df['text_content'] = df['title'] # Fallback básico
-    
-    df['price'] = df['price'].fillna('Consultar')
-    df['text_content'] = df['text_content'].fillna('')
+def embed_texts(model, processor, texts, device):
+    """Embeddings de texto CLIP normalizados para un lote completo"""
+    inputs = processor(text=texts, return_tensors="pt", padding=True,
+                       truncation=True, max_length=MAX_TEXT_TOKENS).to(device)
+    with torch.no_grad():
+        features = model.get_text_features(**inputs)
+
+    # Safety check para tensores
+    if not isinstance(features, torch.Tensor):
+        features = features.text_embeds if hasattr(features, 'text_embeds') else features[0]
+
+    features = features / features.norm(p=2, dim=-1, keepdim=True)
+    return features.cpu().numpy().tolist()
+
+def save_thumbnail(image_path, image):
+    """
+    Guarda la miniatura JPEG como THUMB_DIR/ab/<sha1 del archivo original>.jpg.
+    Si ya existe (mismo original en otro reindexado) no se vuelve a codificar.
+    """
+    with open(image_path, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    path = os.path.join(THUMB_DIR, digest[:2], f"{digest}.jpg")
+
+    if os.path.exists(path):
+        os.utime(path) # Marca de uso reciente: gc_thumbnails no toca miniaturas recien usadas
+        return path
+
+    thumb = image.convert("RGB")
+    thumb.thumbnail(THUMB_SIZE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp" # Varios shards pueden escribir la misma miniatura
+    thumb.save(tmp_path, format="JPEG", quality=THUMB_QUALITY, optimize=True)
+    os.replace(tmp_path, path)
+    return path
+
+def validate_shard(collection, text_collection, expected_count):
+    """
+    Comprueba un shard antes de publicar el snapshot: conteos correctos y que cada
+    vector de muestra encuentre un top-1 a distancia ~0 en ambas colecciones
+    (no se exige el mismo id: productos con la misma foto dan vectores iguales).
+    """
+    if expected_count == 0:
+        return False, "El shard está vacío"
+    for col in (collection, text_collection):
+        if col.count() != expected_count:
+            return False, f"'{col.name}' tiene {col.count()} ítems, se esperaban {expected_count}"
+
+    sample = collection.peek(limit=VALIDATION_SAMPLES)
+    for col in (collection, text_collection):
+        data = col.get(ids=sample['ids'], include=["embeddings"])
+        results = col.query(query_embeddings=data['embeddings'], n_results=1, include=["distances"])
+        for sample_id, dists in zip(data['ids'], results['distances']):
+            if not dists or dists[0] > 1e-3:
+                return False, f"Consulta de prueba fallida en '{col.name}' para id {sample_id}"
+    return True, "OK"
+
+def shard_of(key, num_shards):
+    """Asignacion estable (crc32, no hash() que cambia entre procesos)"""
+    return zlib.crc32(str(key).encode("utf-8")) % num_shards
+
+def partition(df, num_shards):
+    """Divide el corpus en shards. Las variantes de un producto quedan juntas."""
+    if num_shards <= 1:
+        return [df]
+
+    key_column = 'parent_asin'
+    if SHARD_BY == 'category':
+        if 'category' in df.columns:
+            key_column = 'category'
+        else:
+            print("   'category' no detectado. Particionando por hash de parent_asin.")
+
+    shard_ids = df[key_column].map(lambda key: shard_of(key, num_shards))
+    return [df[shard_ids == i] for i in range(num_shards)]
+
+def build_shard(shard_dir, df, torch_threads=None):
+    """
+    Construye las colecciones de un shard en shard_dir y las valida.
+    Se ejecuta en un proceso propio cuando hay varios shards.
+    Devuelve (items_insertados, errores_de_archivo, ok, motivo, miniaturas).
+    """
+    shard_name = os.path.basename(shard_dir)
+    if torch_threads:
+        torch.set_num_threads(torch_threads) # Evitar que N procesos compitan por todos los cores
 
     # 2. Cargar CLIP
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f" Cargando CLIP en: {device} ...")
+    print(f" [{shard_name}] Cargando CLIP en: {device} ...")
     try:
         model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(device)
         processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
     except Exception as e:
-        print(f" Error cargando modelo: {e}")
-        return
+        return 0, 0, False, f"Error cargando modelo: {e}", []
 
-    # 3. Iniciar DB
-    print(f" Conectando a ChromaDB en: {DB_PATH}")
+    # 3. Iniciar DB del shard
     try:
-        client = chromadb.PersistentClient(path=DB_PATH)
-        try:
-            client.delete_collection(name=COLLECTION_NAME)
-            print("   (Colección vieja borrada para actualizar datos)")
-        except:
-            pass
+        client = chromadb.PersistentClient(path=shard_dir)
         collection = client.create_collection(name=COLLECTION_NAME, metadata={"hnsw:space": "cosine"})
+        text_collection = client.create_collection(name=TEXT_COLLECTION_NAME, metadata={"hnsw:space": "cosine"})
     except Exception as e:
-        print(f" Error iniciando DB: {e}")
-        return
+        return 0, 0, False, f"Error iniciando DB: {e}", []
 
     # 4. Procesamiento
-    print(" Procesando imágenes e insertando...")
-    
     batch_ids = []
     batch_embeddings = []
     batch_metadatas = []
+    batch_texts = []
     
     total_inserted = 0
     errors_files = 0
+    thumb_paths = set()
     
-    for idx, row in df.iterrows():
-        if idx % 10 == 0:
-            sys.stdout.write(f"\r   Procesando item {idx}/{len(df)}...")
+    for n, (_, row) in enumerate(df.iterrows()):
+        if n % 10 == 0:
+            sys.stdout.write(f"\r   [{shard_name}] Procesando item {n}/{len(df)}...")
             sys.stdout.flush()
 
         raw_path = str(row['image_path'])
@@ -97,6 +166,9 @@ def main():
 
             features = features / features.norm(p=2, dim=-1, keepdim=True)
             emb = features.cpu().numpy().tolist()[0]
+
+            # -- Miniatura para la interfaz --
+            thumb_path = save_thumbnail(image_path, image)
             
             description_text = str(row['text_content'])
             if len(description_text) > 800: # Recortar si es gigante para no saturar DB
@@ -107,6 +179,7 @@ def main():
                 "title": str(row['title']), 
                 "parent_asin": str(row['parent_asin']),
                 "image_path": raw_path,
+                "thumb_path": thumb_path,
                 "price": str(row['price']),         # <--- AQUÍ ESTABA EL FALLO
                 "text_content": description_text    # <--- AQUÍ ESTABA EL FALLO
             }
@@ -114,13 +187,18 @@ def main():
             batch_ids.append(str(row['id']))
             batch_embeddings.append(emb)
             batch_metadatas.append(meta)
+            thumb_paths.add(thumb_path)
+            # -- Texto para el embedding textual (el tokenizer recorta a 77 tokens) --
+            batch_texts.append(f"{row['title']}. {description_text}")
 
             if len(batch_ids) >= BATCH_SIZE:
                 collection.add(ids=batch_ids, embeddings=batch_embeddings, metadatas=batch_metadatas)
+                text_collection.add(ids=batch_ids, embeddings=embed_texts(model, processor, batch_texts, device))
                 total_inserted += len(batch_ids)
                 batch_ids = []
                 batch_embeddings = []
                 batch_metadatas = []
+                batch_texts = []
 
         except Exception as e_img:
             # print(f"Error silencioso en img: {e_img}")
@@ -128,11 +206,102 @@ def main():
 
     if batch_ids:
         collection.add(ids=batch_ids, embeddings=batch_embeddings, metadatas=batch_metadatas)
+        text_collection.add(ids=batch_ids, embeddings=embed_texts(model, processor, batch_texts, device))
         total_inserted += len(batch_ids)
 
-    print(f"\n\n🏁 PROCESO TERMINADO")
-    print(f"   Items actualizados en DB: {total_inserted}")
-    print(" AHORA LA DB TIENE PRECIOS Y DESCRIPCIONES.")
+    ok, reason = validate_shard(collection, text_collection, total_inserted)
+    return total_inserted, errors_files, ok, reason, sorted(thumb_paths)
+
+def main():
+    print("INICIANDO INDEXADOR V5")
+    
+    # 1. Cargar CSV
+    if not os.path.exists(CSV_PATH):
+        print(f"Error: No existe {CSV_PATH}")
+        return
+    
+    df = pd.read_csv(CSV_PATH)
+    print(f" Total ítems en CSV: {len(df)}")
+    
+    # --- DIAGNÓSTICO DE COLUMNAS ---
+    # Vamos a asegurarnos de que el precio y descripción existan
+    print(f"   Columnas detectadas: {list(df.columns)}")
+    
+    # Rellenar vacíos para que no rompa el código
+    if 'price' not in df.columns:
+        df['price'] = "N/A"
+    if 'text_content' not in df.columns:
+        # Si no hay text_content, intentamos crear uno con title + description si existen
+        print("'text_content' no detectado. Intentando construirlo...")
+        df['text_content'] = df['title'] # Fallback básico
+    
+    df['price'] = df['price'].fillna('Consultar')
+    df['text_content'] = df['text_content'].fillna('')
+
+    # Snapshot nuevo: el índice activo no se toca mientras se construye
+    snapshot_dir = new_snapshot_dir()
+    parts = [(f"shard_{i:02d}", part) for i, part in enumerate(partition(df, NUM_SHARDS)) if len(part)]
+    print(f" Construyendo snapshot en: {snapshot_dir} ({len(parts)} shard/s)")
+    if not parts:
+        print(" Error: el corpus está vacío.")
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        return
+
+    # Si algo falla o se interrumpe antes de publicar, el snapshot a medias se borra
+    published = False
+    try:
+        # Cada shard es un grafo HNSW independiente: se construyen en paralelo
+        if len(parts) == 1:
+            shard_name, part = parts[0]
+            results = [build_shard(os.path.join(snapshot_dir, shard_name), part)]
+        else:
+            torch_threads = max(1, (os.cpu_count() or 1) // len(parts))
+            # spawn: CUDA y los hilos de torch no sobreviven a fork
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=len(parts), mp_context=ctx) as pool:
+                futures = [
+                    pool.submit(build_shard, os.path.join(snapshot_dir, shard_name), part, torch_threads)
+                    for shard_name, part in parts
+                ]
+                results = [f.result() for f in futures]
+
+        # 5. Validar y publicar
+        total_inserted = 0
+        errors_files = 0
+        thumbnails = set()
+        for (shard_name, _), (inserted, errors, ok, reason, thumbs) in zip(parts, results):
+            total_inserted += inserted
+            errors_files += errors
+            thumbnails.update(thumbs)
+            if not ok:
+                print(f"\n Snapshot descartado: [{shard_name}] {reason}")
+                return
+
+        write_manifest(snapshot_dir, {
+            "count": total_inserted,
+            "collections": [COLLECTION_NAME, TEXT_COLLECTION_NAME],
+            "shards": [shard_name for shard_name, _ in parts],
+            "shard_by": SHARD_BY if len(parts) > 1 else None,
+            "thumbnails": sorted(thumbnails), # Inventario para gc_thumbnails
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S")
+        })
+        previous = publish(snapshot_dir)
+        published = True
+    finally:
+        if not published:
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    removed = gc_snapshots(protect=[previous])
+    removed_thumbs = gc_thumbnails()
+
+    print(f"\n🏁 PROCESO TERMINADO")
+    print(f"   Items en el snapshot: {total_inserted} ({errors_files} imágenes no encontradas)")
+    print(f"   Snapshot activo: {snapshot_dir}")
+    if removed:
+        print(f"   Snapshots antiguos eliminados: {', '.join(removed)}")
+    if removed_thumbs:
+        print(f"   Miniaturas huérfanas eliminadas: {removed_thumbs}")
+    print(" LOS RETRIEVERS EN EJECUCIÓN CAMBIARÁN A ESTA VERSIÓN SIN REINICIAR.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
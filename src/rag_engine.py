@@ -14,12 +14,12 @@ class RagEngine:
             except Exception as e:
                 print(f"[ERROR] RAG: {e}")
 
-    def rewrite_query(self, query, history):
+    def rewrite_query(self, query, history, summary=""):
         """
         Mejora la reescritura para mantener atributos (color, marca) 
         pero detectar cambios de tema.
         """
-        if not self.model or not history:
+        if not self.model or not (history or summary):
             return query
             
         # Tomamos los últimos 3 mensajes para no saturar, pero tener contexto reciente
@@ -28,6 +28,9 @@ class RagEngine:
         prompt = f"""
         Actúa como un experto en búsqueda semántica. Tu objetivo es reformular la consulta del usuario para que sea AUTÓNOMA y COMPLETA.
         
+        RESUMEN DE LA CONVERSACIÓN ANTERIOR:
+        {summary or "(ninguno)"}
+        
         HISTORIAL DE CHAT RECIENTE:
         {recent_history}
         
@@ -50,6 +53,37 @@ class RagEngine:
         except:
             return query
 
+    def summarize_history(self, summary, messages):
+        """
+        Pliega mensajes antiguos en el resumen acumulado de la sesión.
+        Sin API Key (o si falla) se conserva un extracto de cada mensaje.
+        """
+        if not messages:
+            return summary
+
+        excerpt = " | ".join(m[:200] for m in messages)
+        fallback = f"{summary} | {excerpt}" if summary else excerpt
+        if not self.model:
+            return fallback
+
+        prompt = f"""
+        Resume la conversación de compras para usarla como contexto en búsquedas futuras.
+        Conserva productos buscados, marcas, colores, precios y preferencias del usuario.
+        
+        RESUMEN PREVIO:
+        {summary or "(vacío)"}
+        
+        MENSAJES NUEVOS A INCORPORAR:
+        {messages}
+        
+        Responde ÚNICAMENTE con el resumen actualizado, en menos de 120 palabras.
+        """
+        try:
+            response = self.model.generate_content(prompt)
+            return response.text.strip()
+        except:
+            return fallback
+
     def analyze_intent(self, query, history):
         if not self.model: return "SEARCH"
         if "[Imagen]" in query: return "SEARCH"
@@ -69,7 +103,7 @@ class RagEngine:
         except:
             return "SEARCH"
 
-    def generate_response(self, query, top_products, history=[], intent="SEARCH"):
+    def generate_response(self, query, top_products, history=[], intent="SEARCH", summary=""):
         """
         Genera una respuesta altamente detallada y estructurada.
         """
@@ -111,6 +145,9 @@ class RagEngine:
         full_prompt = f"""
         {system_instruction}
         
+        RESUMEN DE LA CONVERSACIÓN ANTERIOR:
+        {summary or "(ninguno)"}
+        
         CONTEXTO DE LA CONVERSACIÓN:
         {history[-5:]}
         
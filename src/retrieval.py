@@ -1,13 +1,38 @@
 import chromadb
+from chromadb.api.shared_system_client import SharedSystemClient
 from transformers import CLIPProcessor, CLIPModel
 from PIL import Image
+import numpy as np
 import torch
 import os
+import time
+import heapq
+import hashlib
+import io
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from src.snapshots import resolve_db_path, read_manifest
+except ImportError:  # Ejecutado como script: python src/retrieval.py
+    from snapshots import resolve_db_path, read_manifest
 
 # --- CONFIGURACION ---
-DB_PATH = 'db/chroma_db'
 COLLECTION_NAME = 'amazon_products'
+TEXT_COLLECTION_NAME = 'amazon_products_text'
 MODEL_ID = "openai/clip-vit-base-patch32"
+MAX_TEXT_TOKENS = 77
+# Pesos de la fusion tardia (imagen vs texto del producto)
+IMAGE_WEIGHT = 0.5
+TEXT_WEIGHT = 0.5
+FUSION_POOL_FACTOR = 2  # Candidatos por coleccion = k * factor
+VERSION_CHECK_INTERVAL = 5  # Segundos entre lecturas del puntero de version del indice
+RELEASE_GRACE_PERIOD = 30  # Segundos que se mantiene abierta la version anterior tras un swap
+SEARCH_WORKERS = os.cpu_count() or 4  # Hilos para consultar shards en paralelo
+QUERY_IMAGE_MIN_SIDE = 224  # CLIP recorta a 224x224: reducir antes ahorra el preprocesado de fotos enormes
+IMAGE_CACHE_SIZE = 64  # Embeddings de imagenes de consulta recientes (clave: hash del contenido)
 
 class Retriever:
     def __init__(self):
@@ -22,14 +47,114 @@ class Retriever:
             raise e
 
         try:
-            client = chromadb.PersistentClient(path=DB_PATH)
-            self.collection = client.get_collection(name=COLLECTION_NAME)
-            count = self.collection.count()
-            print(f"[INFO] Conectado a DB. Documentos: {count}")
+            self.index = self._open_index(resolve_db_path())
+            self._last_version_check = time.monotonic()
         except Exception as e:
             print(f"[ERROR] Fallo ChromaDB: {e}")
             raise e
 
+        self._pool = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+        self._swap_lock = threading.Lock() # Streamlit comparte este Retriever entre hilos de sesion
+        self._image_cache = OrderedDict()
+        self._image_cache_lock = threading.Lock()
+
+    def _open_shard(self, shard_path):
+        """Abre las colecciones de un shard"""
+        client = chromadb.PersistentClient(path=shard_path)
+        collection = client.get_collection(name=COLLECTION_NAME)
+
+        # Coleccion de texto opcional: indices antiguos solo tienen la de imagen
+        try:
+            text_collection = client.get_collection(name=TEXT_COLLECTION_NAME)
+        except Exception:
+            text_collection = None
+            print(f"[WARN] Sin coleccion de texto en {shard_path}. La busqueda hibrida usara solo imagen.")
+
+        return {"client": client, "collection": collection, "text_collection": text_collection}
+
+    def _open_index(self, db_path):
+        """Abre todos los shards de una version del indice"""
+        # La DB antigua (sin manifest) es un unico shard en la raiz
+        shard_names = read_manifest(db_path).get("shards")
+        shard_paths = [os.path.join(db_path, name) for name in shard_names] if shard_names else [db_path]
+        shards = [self._open_shard(path) for path in shard_paths]
+        count = sum(shard["collection"].count() for shard in shards)
+        print(f"[INFO] Conectado a DB ({db_path}). Shards: {len(shards)}. Documentos: {count}")
+        return {"path": db_path, "shards": shards}
+
+    def _active_index(self):
+        """
+        Devuelve el indice vigente. Cada VERSION_CHECK_INTERVAL segundos relee el
+        puntero de version; si el indexador publico un snapshot nuevo se abre y se
+        reemplaza self.index en una sola asignacion (las busquedas en curso siguen
+        con la referencia anterior). El chequeo y el swap van bajo _swap_lock: dos
+        hilos que abrieran el mismo snapshot compartirian el System de Chroma y uno
+        terminaria liberando el indice activo.
+        """
+        if time.monotonic() - self._last_version_check < VERSION_CHECK_INTERVAL:
+            return self.index
+
+        with self._swap_lock:
+            now = time.monotonic()
+            if now - self._last_version_check < VERSION_CHECK_INTERVAL:
+                return self.index # Otro hilo acaba de revisar
+            self._last_version_check = now
+
+            db_path = resolve_db_path()
+            if db_path == self.index["path"]:
+                return self.index
+            try:
+                new_index = self._open_index(db_path)
+            except Exception as e:
+                print(f"[WARN] No se pudo abrir {db_path}, se mantiene {self.index['path']}: {e}")
+                return self.index
+
+            old_index, self.index = self.index, new_index
+            print(f"[INFO] Nueva version del indice activa: {db_path}")
+
+        # Las busquedas en curso aun pueden usar la version vieja: se cierra mas tarde
+        timer = threading.Timer(RELEASE_GRACE_PERIOD, self._release_index, args=(old_index,))
+        timer.daemon = True
+        timer.start()
+        return new_index
+
+    def _release_index(self, index):
+        """
+        Libera los clientes de Chroma de una version reemplazada. Chroma guarda un
+        System por ruta a nivel de clase; sin esto cada reindexado dejaria el HNSW
+        y los handles de sqlite del snapshot viejo en memoria.
+        """
+        with self._swap_lock:
+            # Si el puntero volvio a esta ruta, el indice activo comparte su System
+            if index["path"] == self.index["path"]:
+                return
+            for shard in index["shards"]:
+                client = shard["client"]
+                try:
+                    system = SharedSystemClient._identifier_to_system.pop(client._identifier, None)
+                    if system is not None:
+                        system.stop()
+                except Exception as e:
+                    print(f"[WARN] No se pudo liberar {index['path']}: {e}")
+        print(f"[INFO] Version anterior del indice liberada: {index['path']}")
+
+    def _scatter_gather(self, search_shard, k, shards=None):
+        """
+        Ejecuta search_shard(shard) sobre todos los shards en paralelo y une los
+        top-k parciales con un heap. Cada shard devuelve ya el formato de _format_results.
+        shards permite fijar la version ya resuelta por el llamador.
+        """
+        if shards is None:
+            shards = self._active_index()["shards"]
+        partials = self._map_shards(search_shard, shards)
+        return heapq.nlargest(k, itertools.chain.from_iterable(partials), key=lambda r: r["score"])
+
+    def _map_shards(self, fn, shards):
+        """fn(shard) sobre cada shard, en paralelo si hay mas de uno"""
+        if len(shards) == 1:
+            return [fn(shards[0])]
+        return list(self._pool.map(fn, shards))
+
     def _safe_extract(self, features):
         """Extrae el tensor si CLIP devuelve un objeto"""
         if not isinstance(features, torch.Tensor):
@@ -43,37 +168,185 @@ class Retriever:
                 return features[0]
         return features
 
-    def search_by_text(self, query_text, k=5):
-        print(f"\n🔝 Buscando texto: '{query_text}'")
-        inputs = self.processor(text=[query_text], return_tensors="pt", padding=True).to(self.device)
+    def _embed_text(self, query_text):
+        inputs = self.processor(text=[query_text], return_tensors="pt", padding=True,
+                                truncation=True, max_length=MAX_TEXT_TOKENS).to(self.device)
         with torch.no_grad():
             text_features = self.model.get_text_features(**inputs)
             text_features = self._safe_extract(text_features) # SAFETY CHECK
         
         text_features = text_features / text_features.norm(p=2, dim=-1, keepdim=True)
-        query_emb = text_features.cpu().numpy().tolist()
+        return text_features.cpu().numpy().tolist()
 
-        results = self.collection.query(
-            query_embeddings=query_emb, n_results=k, include=["metadatas", "distances"]
-        )
-        return self._format_results(results)
-
-    def search_by_image(self, image_path, k=5):
-        print(f"\n🖼︝ Buscando imagen: '{image_path}'")
-        if not os.path.exists(image_path):
-            print("[ERROR] Imagen no existe.")
-            return []
-
-        image = Image.open(image_path)
+    def _embed_image(self, image):
         inputs = self.processor(images=image, return_tensors="pt").to(self.device)
         with torch.no_grad():
             image_features = self.model.get_image_features(**inputs)
             image_features = self._safe_extract(image_features) # SAFETY CHECK
         
         image_features = image_features / image_features.norm(p=2, dim=-1, keepdim=True)
-        query_emb = image_features.cpu().numpy().tolist()
+        return image_features.cpu().numpy().tolist()
+
+    def search_by_text(self, query_text, k=5):
+        print(f"\n🔝 Buscando texto: '{query_text}'")
+        query_emb = self._embed_text(query_text)
+        return self._scatter_gather(lambda shard: self._query_shard(shard, query_emb, k), k)
+
+    def search_hybrid(self, query_text, k=5, image_weight=IMAGE_WEIGHT, text_weight=TEXT_WEIGHT):
+        """
+        Fusion tardia ponderada: el embedding de la consulta se compara contra
+        el vector de imagen y el de texto de cada producto. Cada pata se normaliza
+        (min-max) sobre el pool de candidatos de todos los shards antes de ponderar:
+        los cosenos texto-imagen de CLIP (~0.2-0.35) y texto-texto (~0.6-0.95) no
+        estan en la misma escala y sin normalizar la pata de texto decidiria sola.
+        """
+        # Una sola resolucion: un swap entre el chequeo y la consulta no puede colar un shard sin texto
+        shards = self._active_index()["shards"]
+        if any(shard["text_collection"] is None for shard in shards):
+            return self.search_by_text(query_text, k=k)
+
+        print(f"\n🔝 Busqueda hibrida: '{query_text}'")
+        query_emb = self._embed_text(query_text)
+        pool_k = k * FUSION_POOL_FACTOR
+        partials = [
+            p for p in self._map_shards(lambda shard: self._shard_fusion_pool(shard, query_emb, pool_k), shards)
+            if p["ids"]
+        ]
+        if not partials:
+            return []
+
+        # Pool global: la normalizacion tiene que ser la misma para todos los shards
+        ids = [i for p in partials for i in p["ids"]]
+        metadatas = [m for p in partials for m in p["metadatas"]]
+        image_scores = np.concatenate([p["image_scores"] for p in partials])
+        text_scores = np.concatenate([p["text_scores"] for p in partials])
+
+        total_weight = (image_weight + text_weight) or 1.0
+        scores = (image_weight * self._min_max(image_scores) + text_weight * self._min_max(text_scores)) / total_weight
+
+        top = np.argsort(-scores)[:k]
+        return [
+            {"id": ids[i], "score": float(scores[i]), "metadata": metadatas[i]}
+            for i in top
+        ]
+
+    def _min_max(self, values):
+        """Escala a [0, 1] sobre el pool. NaN (vector faltante) cuenta como el peor."""
+        low, high = np.nanmin(values), np.nanmax(values)
+        if not np.isfinite(low) or high - low < 1e-9:
+            return np.zeros_like(values)
+        return np.nan_to_num((values - low) / (high - low), nan=0.0)
+
+    def _shard_fusion_pool(self, shard, query_emb, pool_k):
+        """Candidatos de un shard con sus cosenos crudos contra imagen y texto"""
+        # 1. Pool de candidatos: union del top de cada coleccion
+        image_hits = shard["collection"].query(query_embeddings=query_emb, n_results=pool_k, include=["distances"])
+        text_hits = shard["text_collection"].query(query_embeddings=query_emb, n_results=pool_k, include=["distances"])
+        ids = list(dict.fromkeys(image_hits['ids'][0] + text_hits['ids'][0]))
+        if not ids:
+            return {"ids": []}
+
+        # 2. Traer ambos vectores de todos los candidatos (get no garantiza el orden)
+        image_data = shard["collection"].get(ids=ids, include=["embeddings", "metadatas"])
+        text_data = shard["text_collection"].get(ids=ids, include=["embeddings"])
+        image_vecs = dict(zip(image_data['ids'], image_data['embeddings']))
+        metadatas = dict(zip(image_data['ids'], image_data['metadatas']))
+        text_vecs = dict(zip(text_data['ids'], text_data['embeddings']))
+
+        ids = [i for i in ids if i in image_vecs]
+        dim = len(query_emb[0])
+        missing = np.full(dim, np.nan, dtype=np.float32)
+        image_matrix = np.asarray([image_vecs[i] for i in ids], dtype=np.float32)
+        text_matrix = np.asarray([text_vecs.get(i, missing) for i in ids], dtype=np.float32)
+
+        # 3. Scoring vectorizado (vectores normalizados -> producto punto = coseno)
+        q = np.asarray(query_emb[0], dtype=np.float32)
+        return {
+            "ids": ids,
+            "metadatas": [metadatas[i] for i in ids],
+            "image_scores": image_matrix @ q,
+            "text_scores": text_matrix @ q
+        }
+
+    def _load_query_image(self, image):
+        """
+        Acepta ruta, bytes o PIL.Image. Devuelve (clave_de_contenido, imagen_reducida)
+        o (None, None) si la imagen no existe.
+        """
+        if isinstance(image, Image.Image):
+            # Reducir primero y hashear el resultado (pixeles pequenos + modo + tamano):
+            # tobytes() solo no distingue 100x200 de 200x100 ni L de P
+            small = self._downscale(image)
+            digest = hashlib.sha1(f"{small.mode}:{small.size}".encode("utf-8"))
+            digest.update(small.tobytes())
+            return digest.hexdigest(), lambda: small
+
+        if isinstance(image, (str, os.PathLike)):
+            if not os.path.exists(image):
+                return None, None
+            with open(image, "rb") as f:
+                image = f.read()
+
+        data = bytes(image)
+        key = hashlib.sha1(data).hexdigest()
+
+        def load():
+            img = Image.open(io.BytesIO(data))
+            # JPEG: decodificar directamente a menor resolucion (no hace nada en otros formatos)
+            img.draft("RGB", (QUERY_IMAGE_MIN_SIDE, QUERY_IMAGE_MIN_SIDE))
+            return self._downscale(img)
+        return key, load
+
+    def _downscale(self, image):
+        """Reduce la imagen para que su lado menor sea QUERY_IMAGE_MIN_SIDE"""
+        target = QUERY_IMAGE_MIN_SIDE
+        image = image.convert("RGB")
+        scale = target / min(image.size)
+        if scale < 1:
+            new_size = (max(target, round(image.width * scale)), max(target, round(image.height * scale)))
+            image = image.resize(new_size, Image.Resampling.BICUBIC, reducing_gap=2.0)
+        return image
+
+    def _cached_image_embedding(self, key, load_image):
+        with self._image_cache_lock:
+            if key in self._image_cache:
+                self._image_cache.move_to_end(key)
+                return self._image_cache[key]
+
+        query_emb = self._embed_image(load_image())
+
+        with self._image_cache_lock:
+            self._image_cache[key] = query_emb
+            if len(self._image_cache) > IMAGE_CACHE_SIZE:
+                self._image_cache.popitem(last=False)
+        return query_emb
+
+    def search_by_image(self, image, k=5):
+        """image puede ser una ruta, los bytes del archivo o una PIL.Image"""
+        label = image if isinstance(image, (str, os.PathLike)) else type(image).__name__
+        print(f"\n🖼︝ Buscando imagen: '{label}'")
+        key, load_image = self._load_query_image(image)
+        if key is None:
+            print("[ERROR] Imagen no existe.")
+            return []
+
+        query_emb = self._cached_image_embedding(key, load_image)
+        return self._scatter_gather(lambda shard: self._query_shard(shard, query_emb, k), k)
+
+    def index_path(self):
+        """Ruta de la version del indice vigente (sirve como clave de caches externos)"""
+        return self._active_index()["path"]
+
+    def get_metadatas(self, ids):
+        """Metadata por id ({id: metadata}); las sesiones solo guardan los ids"""
+        found = {}
+        for shard in self._active_index()["shards"]:
+            data = shard["collection"].get(ids=list(ids), include=["metadatas"])
+            found.update(zip(data['ids'], data['metadatas']))
+        return found
 
-        results = self.collection.query(
+    def _query_shard(self, shard, query_emb, k):
+        results = shard["collection"].query(
             query_embeddings=query_emb, n_results=k, include=["metadatas", "distances"]
         )
         return self._format_results(results)
@@ -97,6 +370,6 @@ class Retriever:
 if __name__ == "__main__":
     # Test rápido
     r = Retriever()
-    res = r.search_by_text("kindle", k=1)
+    res = r.search_hybrid("kindle", k=1)
     if res:
         print(f"Top 1: {res[0]['metadata']['title']}")
\ No newline at end of file
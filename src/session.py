@@ -0,0 +1,80 @@
+# --- CONFIGURACION ---
+MAX_TURNS = 6                       # Intercambios (usuario + asistente) que se conservan completos
+MAX_SESSION_BYTES = 512 * 1024      # Techo de memoria por sesión (estimado)
+SUMMARY_MAX_CHARS = 2000            # Largo máximo del resumen acumulado
+PRODUCT_RECORD_BYTES = 64           # Estimación por producto guardado (id + scores)
+
+def compact_product(product):
+    """Lo mínimo para volver a mostrar un resultado: id y scores"""
+    return {
+        "id": product['id'],
+        "score": product.get('score'),
+        "rerank_score": product.get('rerank_score')
+    }
+
+class ConversationMemory:
+    """
+    Estado compacto de una conversación de Streamlit.
+    Los productos se guardan como ids + scores (la metadata se vuelve a pedir
+    al Retriever al mostrarlos) y los turnos antiguos se pliegan en un resumen
+    que consume el RagEngine.
+    """
+    def __init__(self, max_turns=MAX_TURNS, max_bytes=MAX_SESSION_BYTES):
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self.messages = []
+        self.summary = ""
+        self.summarized_messages = 0
+        self.last_results = []      # Último resultado de búsqueda (para la intención DETAILS)
+
+    def add_user(self, content, image=None):
+        msg = {"role": "user", "content": content}
+        if image:
+            msg["image"] = image
+        self.messages.append(msg)
+
+    def add_assistant(self, content, products=None):
+        records = [compact_product(p) for p in products or []]
+        self.messages.append({"role": "assistant", "content": content, "products": records})
+        if records:
+            self.last_results = records
+
+    def history_text(self):
+        return [m["content"] for m in self.messages]
+
+    def size_bytes(self):
+        total = len(self.summary.encode("utf-8"))
+        for m in self.messages:
+            total += len(m["content"].encode("utf-8"))
+            total += len(m.get("image") or b"")
+            total += PRODUCT_RECORD_BYTES * len(m.get("products", []))
+        return total
+
+    def _over_limit(self, max_turns, max_bytes):
+        return len(self.messages) > 2 * max_turns or self.size_bytes() > max_bytes
+
+    def compact(self, summarize):
+        """
+        Cuando se supera el número de turnos o el techo de memoria, saca los turnos
+        más antiguos hasta bajar a la mitad de ambos límites (histéresis: el resumen,
+        que es una llamada al LLM, no se paga en cada turno) y los pliega con
+        summarize(resumen_previo, contenidos) -> nuevo resumen.
+        El último intercambio siempre se conserva.
+        """
+        if not self._over_limit(self.max_turns, self.max_bytes):
+            return 0
+
+        low_turns = max(1, self.max_turns // 2)
+        low_bytes = self.max_bytes // 2
+        evicted = []
+        while len(self.messages) > 2 and self._over_limit(low_turns, low_bytes):
+            # Un turno = mensaje del usuario + respuesta(s) del asistente
+            evicted.append(self.messages.pop(0))
+            while self.messages and self.messages[0]["role"] != "user":
+                evicted.append(self.messages.pop(0))
+
+        if evicted:
+            new_summary = summarize(self.summary, [m["content"] for m in evicted])
+            self.summary = new_summary[-SUMMARY_MAX_CHARS:]
+            self.summarized_messages += len(evicted)
+        return len(evicted)
@@ -0,0 +1,126 @@
+import json
+import os
+import shutil
+import time
+
+# --- CONFIGURACION ---
+SNAPSHOT_ROOT = 'db/snapshots'      # Cada reindexado crea aqui un directorio versionado
+POINTER_PATH = 'db/CURRENT'         # Nombre del snapshot activo (se reemplaza de forma atomica)
+LEGACY_DB_PATH = 'db/chroma_db'     # Indice previo a los snapshots, se usa si no hay puntero
+MANIFEST_NAME = 'manifest.json'
+KEEP_SNAPSHOTS = 2                  # Activo + anterior (lectores que aun no hicieron el swap)
+THUMB_DIR = 'db/thumbnails'         # Miniaturas por hash del original (compartidas entre snapshots)
+THUMB_SIZE = (256, 256)
+THUMB_QUALITY = 80
+THUMB_GC_MIN_AGE = 3600             # Segundos: no borrar miniaturas que un build en curso acaba de usar
+
+def new_snapshot_dir():
+    """Crea un directorio vacio para construir una nueva version del indice"""
+    version = time.strftime("v%Y%m%d_%H%M%S")
+    path = os.path.join(SNAPSHOT_ROOT, version)
+    suffix = 1
+    while os.path.exists(path):
+        path = os.path.join(SNAPSHOT_ROOT, f"{version}_{suffix}")
+        suffix += 1
+    os.makedirs(path)
+    return path
+
+def read_current():
+    """Devuelve la ruta del snapshot activo o None si nunca se publico uno"""
+    try:
+        with open(POINTER_PATH, encoding="utf-8") as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    if not version:
+        return None
+    return os.path.join(SNAPSHOT_ROOT, version)
+
+def resolve_db_path():
+    """Ruta que deben abrir los lectores: snapshot activo o la DB antigua"""
+    return read_current() or LEGACY_DB_PATH
+
+def write_manifest(snapshot_dir, info):
+    with open(os.path.join(snapshot_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+
+def read_manifest(db_path):
+    """Manifest del snapshot ({} para la DB antigua, que no tiene)"""
+    try:
+        with open(os.path.join(db_path, MANIFEST_NAME), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def publish(snapshot_dir):
+    """
+    Activa el snapshot. Se escribe un archivo temporal y se renombra sobre el
+    puntero: os.replace es atomico, asi que un lector nunca ve un puntero a medias.
+    Devuelve la ruta del snapshot que estaba activo (o None).
+    """
+    previous = read_current()
+    tmp_path = f"{POINTER_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(os.path.basename(os.path.normpath(snapshot_dir)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, POINTER_PATH)
+    return previous
+
+def gc_snapshots(keep=KEEP_SNAPSHOTS, protect=()):
+    """
+    Borra snapshots publicados viejos. Solo cuentan los que tienen manifest
+    (los directorios sin manifest son builds en curso o abortados y no ocupan
+    lugar). Nunca toca el activo ni los de protect (p. ej. el activo anterior,
+    que lectores sin swap todavia pueden estar usando). Devuelve los eliminados.
+    """
+    if not os.path.isdir(SNAPSHOT_ROOT):
+        return []
+
+    kept = {os.path.basename(os.path.normpath(p)) for p in [read_current(), *protect] if p}
+    versions = sorted(
+        (d for d in os.listdir(SNAPSHOT_ROOT)
+         if os.path.isfile(os.path.join(SNAPSHOT_ROOT, d, MANIFEST_NAME))),
+        reverse=True
+    )
+
+    removed = []
+    for version in versions[keep:]:
+        if version in kept:
+            continue
+        shutil.rmtree(os.path.join(SNAPSHOT_ROOT, version), ignore_errors=True)
+        removed.append(version)
+    return removed
+
+def gc_thumbnails():
+    """
+    Borra miniaturas que ningun snapshot conservado referencia (inventario
+    "thumbnails" del manifest). Devuelve cuantas se eliminaron.
+    """
+    if not os.path.isdir(THUMB_DIR) or not os.path.isdir(SNAPSHOT_ROOT):
+        return 0
+
+    referenced = set()
+    for version in os.listdir(SNAPSHOT_ROOT):
+        manifest_path = os.path.join(SNAPSHOT_ROOT, version, MANIFEST_NAME)
+        if not os.path.isfile(manifest_path):
+            continue # Build en curso o abortado: lo cubre THUMB_GC_MIN_AGE
+        manifest = read_manifest(os.path.join(SNAPSHOT_ROOT, version))
+        if "thumbnails" not in manifest:
+            return 0 # Snapshot sin inventario: no se puede saber que miniaturas usa
+        referenced.update(os.path.normpath(p) for p in manifest["thumbnails"])
+
+    removed = 0
+    cutoff = time.time() - THUMB_GC_MIN_AGE
+    for dirpath, _, filenames in os.walk(THUMB_DIR):
+        for name in filenames:
+            path = os.path.normpath(os.path.join(dirpath, name))
+            if path in referenced:
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed